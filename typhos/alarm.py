@@ -4,9 +4,13 @@ Module to define alarm summary frameworks and widgets.
 import enum
 import logging
 import os
+import threading
+import weakref
 from collections import defaultdict
 from dataclasses import dataclass
-from functools import partial
+from functools import lru_cache
+from operator import attrgetter
+from typing import Callable, Optional
 
 from ophyd.device import Kind
 from ophyd.signal import EpicsSignalBase
@@ -19,7 +23,7 @@ from qtpy import QtCore, QtGui, QtWidgets
 from qtpy.QtCore import Qt
 
 from .plugins import register_signal
-from .utils import (TyphosObject, channel_from_signal,
+from .utils import (ThreadPoolWorker, TyphosObject, channel_from_signal,
                     get_all_signals_from_device, pyqt_class_from_enum)
 from .widgets import HappiChannel
 
@@ -50,34 +54,190 @@ class AlarmLevel(enum.IntEnum):
 _KindLevel = pyqt_class_from_enum(KindLevel)
 _AlarmLevel = pyqt_class_from_enum(AlarmLevel)
 
+# AlarmLevel members indexed by value, quicker than calling AlarmLevel(value)
+_ALARM_LEVELS = tuple(AlarmLevel)
+
+
+# Kind bits that a signal needs at least one of for each KindLevel.
+# Kind.hinted is Kind.normal plus an extra bit, so that extra bit alone is
+# what marks a hinted signal.
+_KIND_MASKS = {
+    KindLevel.HINTED: Kind.hinted.value & ~Kind.normal.value,
+    KindLevel.NORMAL: Kind.normal.value,
+    KindLevel.CONFIG: (Kind.hinted | Kind.normal | Kind.config).value,
+}
 
 # Define behavior for the user's Kind selection.
 KIND_FILTERS = {
     KindLevel.HINTED:
-        (lambda walk: walk.item.kind == Kind.hinted),
+        (lambda walk, mask=_KIND_MASKS[KindLevel.HINTED]:
+            walk.item.kind.value & mask),
     KindLevel.NORMAL:
-        (lambda walk: walk.item.kind in (Kind.hinted, Kind.normal)),
+        (lambda walk, mask=_KIND_MASKS[KindLevel.NORMAL]:
+            walk.item.kind.value & mask),
     KindLevel.CONFIG:
-        (lambda walk: walk.item.kind != Kind.omitted),
+        (lambda walk, mask=_KIND_MASKS[KindLevel.CONFIG]:
+            walk.item.kind.value & mask),
     KindLevel.OMITTED:
         (lambda walk: True),
 }
 
 
+# Signals found for each device, shared between alarm widgets.
+# Only weak references to the signals are kept, as they refer back to their
+# device and would otherwise keep it alive.
+_signal_cache = weakref.WeakKeyDictionary()
+# Guards the signal cache, used from worker threads
+_alarm_cache_lock = threading.Lock()
+
+
+class _SignalWalk:
+    """One walk of a device, shared by everyone who asked for it."""
+    __slots__ = ('done', 'refs', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.refs = None
+        self.error = None
+
+
+def clear_alarm_signal_cache(device=None):
+    """
+    Forget cached results from :func:`get_alarm_signals`.
+
+    Parameters
+    ----------
+    device : ophyd.Device, optional
+        Only forget the results for this device. By default, the results for
+        every device are forgotten.
+    """
+    with _alarm_cache_lock:
+        if device is None:
+            _signal_cache.clear()
+        else:
+            _signal_cache.pop(device, None)
+
+
+def _forget_walk(device, kind_level, walk):
+    """Drop ``walk`` from the cache, unless it was already replaced."""
+    with _alarm_cache_lock:
+        walks = _signal_cache.get(device, {})
+        if walks.get(kind_level) is walk:
+            del walks[kind_level]
+
+
+def get_alarm_signals(device, kind_level):
+    """
+    Get the signals from a device to include in an alarm summary.
+
+    Results are cached per device and KindLevel, so that the many alarm
+    widgets for one device on a screen only need to walk it once. A caller
+    that arrives while the walk is in progress waits for it to finish
+    instead of starting another.
+
+    The cached result goes stale if lazy components are instantiated or a
+    signal's kind is changed. Use :func:`clear_alarm_signal_cache` to force a
+    fresh walk.
+
+    Parameters
+    ----------
+    device : ophyd.Device
+        The device to find signals in.
+
+    kind_level : KindLevel
+        The lowest kind of signal to include.
+
+    Returns
+    -------
+    signals : list of ophyd.Signal
+    """
+    with _alarm_cache_lock:
+        walks = _signal_cache.setdefault(device, {})
+        walk = walks.get(kind_level)
+        owner = walk is None
+        if owner:
+            walk = walks[kind_level] = _SignalWalk()
+
+    if owner:
+        try:
+            sigs = get_all_signals_from_device(
+                device,
+                filter_by=KIND_FILTERS[kind_level]
+            )
+        except Exception as ex:
+            walk.error = ex
+            # Let the next caller try again
+            _forget_walk(device, kind_level, walk)
+            raise
+        else:
+            walk.refs = tuple(weakref.ref(sig) for sig in sigs)
+            return sigs
+        finally:
+            walk.done.set()
+
+    walk.done.wait()
+    if walk.error is not None:
+        raise walk.error
+    sigs = [ref() for ref in walk.refs]
+    if any(sig is None for sig in sigs):
+        # A signal went away since the walk, so it is out of date
+        _forget_walk(device, kind_level, walk)
+        return get_alarm_signals(device, kind_level)
+    return sigs
+
+
 @dataclass
 class SignalInfo:
+    # There is one of these per summarized signal, so skip the __dict__
+    __slots__ = (
+        'address',
+        'channel',
+        'signal_name',
+        'connected',
+        'severity',
+        'alarm_callback',
+        # Qt may hold our bound method slots by weak reference
+        '__weakref__',
+    )
+
     address: str
     channel: PyDMChannel
     signal_name: str
     connected: bool
     severity: int
 
+    def __post_init__(self):
+        # Called with this SignalInfo and its previous AlarmLevel when the
+        # slots below change it. Not a dataclass field so that it stays out
+        # of repr/eq.
+        self.alarm_callback: Optional[
+            Callable[[SignalInfo, AlarmLevel], None]
+        ] = None
+
     @property
     def alarm(self) -> AlarmLevel:
         if not self.connected:
             return AlarmLevel.DISCONNECTED
         else:
-            return AlarmLevel(self.severity)
+            return _ALARM_LEVELS[self.severity]
+
+    def update_connection(self, connected: bool) -> None:
+        """Slot that will be called when the PV connects or disconnects."""
+        if connected == self.connected:
+            return
+        old_alarm = self.alarm
+        self.connected = connected
+        if self.alarm_callback is not None:
+            self.alarm_callback(self, old_alarm)
+
+    def update_severity(self, severity: int) -> None:
+        """Slot that will be called when the PV's alarm severity changes."""
+        if severity == self.severity:
+            return
+        old_alarm = self.alarm
+        self.severity = severity
+        if self.alarm_callback is not None:
+            self.alarm_callback(self, old_alarm)
 
     def describe(self) -> str:
         alarm = self.alarm
@@ -115,16 +275,33 @@ class TyphosAlarm(TyphosObject, PyDMDrawing, _KindLevel, _AlarmLevel):
     }
 
     alarm_changed = QtCore.Signal(_AlarmLevel)
+    # device, config generation, signals, channel addresses
+    _channels_discovered = QtCore.Signal(object, int, object, object)
+
+    # Alarm updates arriving within this many ms are summarized together
+    alarm_update_interval_ms = 50
 
     def __init__(self, *args, **kwargs):
         self._kind_level = KindLevel.HINTED
+        self._alarm_generation = 0
         super().__init__(*args, **kwargs)
+        self._alarm_update_timer = QtCore.QTimer(parent=self)
+        self._alarm_update_timer.setSingleShot(True)
+        self._alarm_update_timer.setInterval(self.alarm_update_interval_ms)
+        self._alarm_update_timer.timeout.connect(self._update_current_alarm)
         # Default drawing properties, can override if needed
         self.penWidth = 2
         self.penColor = QtGui.QColor('black')
         self.penStyle = Qt.SolidLine
+        self._stylesheets = _indicator_stylesheets(type(self))
+        self.signal_info = {}
+        self.device_info = defaultdict(list)
+        # id(SignalInfo) -> (SignalInfo, AlarmLevel it is counted at)
+        self._pending_alarms = {}
         self.reset_alarm_state()
         self.alarm_changed.connect(self.set_alarm_color)
+        self._channels_discovered.connect(
+            self._install_channels, QtCore.Qt.QueuedConnection)
 
     @QtCore.Property(_KindLevel)
     def kindLevel(self):
@@ -170,10 +347,12 @@ class TyphosAlarm(TyphosObject, PyDMDrawing, _KindLevel, _AlarmLevel):
             # Remove old connection
             if self._channels:
                 for channel in self._channels:
-                    if hasattr(channel, 'disconnect'):
-                        channel.disconnect()
-                    if channel in self.signal_info:
-                        del self.signal_info[channel]
+                    if self._device_uses(channel.address):
+                        # Still summarized for one of our devices
+                        continue
+                    channel.disconnect()
+                    if channel.address in self.signal_info:
+                        self._remove_signal_info(channel.address)
                 self._channels.clear()
             # Load new channel
             self._channel = str(value)
@@ -182,33 +361,33 @@ class TyphosAlarm(TyphosObject, PyDMDrawing, _KindLevel, _AlarmLevel):
                     address=self._channel,
                     tx_slot=self._tx,
                 )
+            elif self._channel in self.signal_info:
+                # One of our devices already summarizes this signal
+                return
             else:
-                channel = PyDMChannel(
-                    address=self._channel,
-                    connection_slot=partial(self.update_connection,
-                                            addr=self._channel),
-                    severity_slot=partial(self.update_severity,
-                                          addr=self._channel),
-                )
-                self.signal_info[self._channel] = SignalInfo(
-                    address=self._channel,
-                    channel=channel,
-                    signal_name='',
-                    connected=False,
-                    severity=AlarmLevel.INVALID,
-                )
+                info = self._create_signal_info(self._channel)
+                channel = info.channel
+                self._add_signal_info(info)
             self._channels = [channel]
             # Connect the channel to the HappiPlugin
-            if hasattr(channel, 'connect'):
-                channel.connect()
+            channel.connect()
 
     def _tx(self, value):
         """Receive information from happi channel"""
         self.add_device(value['obj'])
 
     def reset_alarm_state(self):
-        self.signal_info = {}
-        self.device_info = defaultdict(list)
+        # Empty in place, these are refilled right away on kindLevel changes
+        self.signal_info.clear()
+        self.device_info.clear()
+        self._pending_alarms.clear()
+        # Number of signals currently at each AlarmLevel, indexed by level
+        self._alarm_counts = [0] * len(AlarmLevel)
+        # Discard channel discovery started before this reset
+        self._alarm_generation += 1
+        self._pending_discovery = 0
+        # Drop any summary scheduled for the state we just cleared
+        self._alarm_update_timer.stop()
         self.alarm_summary = AlarmLevel.DISCONNECTED
         self.set_alarm_color(AlarmLevel.DISCONNECTED)
 
@@ -232,8 +411,10 @@ class TyphosAlarm(TyphosObject, PyDMDrawing, _KindLevel, _AlarmLevel):
         """
         Reset this widget down to the "no alarm handling" state.
         """
-        for ch in (info.channel for info in self.signal_info.values()):
-            ch.disconnect()
+        for info in self.signal_info.values():
+            # Detach first so that disconnection doesn't touch our counts
+            info.alarm_callback = None
+            info.channel.disconnect()
         self.reset_alarm_state()
 
     def setup_alarm_config(self, device):
@@ -243,34 +424,75 @@ class TyphosAlarm(TyphosObject, PyDMDrawing, _KindLevel, _AlarmLevel):
         This will pick PVs based on the device kind and the configured kind
         level, configuring the PyDMChannels to update our alarm state and
         color when we get updates from our PVs.
+
+        Walking large devices for signals can be slow, so this is done in a
+        thread from the global QThreadPool. The channels are created once the
+        results are back in the GUI thread.
         """
-        sigs = get_all_signals_from_device(
-            device,
-            filter_by=KIND_FILTERS[self._kind_level]
+        self._pending_discovery += 1
+        QtCore.QThreadPool.globalInstance().start(
+            ThreadPoolWorker(
+                self._discover_channels,
+                device,
+                self._kind_level,
+                self._alarm_generation,
+            )
         )
-        channel_addrs = [channel_from_signal(sig) for sig in sigs]
+
+    def _discover_channels(self, device, kind_level, generation):
+        """
+        Find the signals and channel addresses to summarize for a device.
+
+        This runs in a worker thread and must not modify the widget state.
+        The results are always reported back, even on failure, so that the
+        widget does not wait on this device forever.
+        """
+        try:
+            sigs = get_alarm_signals(device, kind_level)
+            channel_addrs = [channel_from_signal(sig) for sig in sigs]
+        except Exception:
+            logger.exception(
+                'Failed to find alarm signals for device %s',
+                device.name,
+            )
+            sigs, channel_addrs = [], []
+        try:
+            self._channels_discovered.emit(
+                device, generation, sigs, channel_addrs)
+        except RuntimeError:
+            # Widget was destroyed while we were walking the device
+            logger.debug('Dangling reference to alarm widget!')
+
+    @QtCore.Slot(object, int, object, object)
+    def _install_channels(self, device, generation, sigs, channel_addrs):
+        """
+        Create and connect the PyDMChannels for a device's signals.
+
+        This is the GUI thread half of :meth:`setup_alarm_config`.
+        """
+        if generation != self._alarm_generation:
+            # The alarm config was reset while this device was being walked
+            return
+        self._pending_discovery -= 1
+
         for sig in sigs:
             if not isinstance(sig, EpicsSignalBase):
                 register_signal(sig)
-        channels = [
-            PyDMChannel(
-                address=addr,
-                connection_slot=partial(self.update_connection, addr=addr),
-                severity_slot=partial(self.update_severity, addr=addr),
-            )
-            for addr in channel_addrs]
-
-        for ch, sig in zip(channels, sigs):
-            info = SignalInfo(
-                address=ch.address,
-                channel=ch,
-                signal_name=sig.dotted_name,
-                connected=False,
-                severity=AlarmLevel.INVALID,
-            )
-            self.signal_info[ch.address] = info
+        new_infos = []
+        for addr, sig in zip(channel_addrs, sigs):
+            # Devices can share signals, only subscribe once per address
+            info = self.signal_info.get(addr)
+            if info is None:
+                info = self._create_signal_info(
+                    addr, signal_name=sig.dotted_name)
+                self._add_signal_info(info)
+                new_infos.append(info)
             self.device_info[device.name].append(info)
-            ch.connect()
+
+        # Connect in a single pass once all the bookkeeping is in place,
+        # sorted so that PVs from the same IOC are searched for together.
+        for info in sorted(new_infos, key=attrgetter('address')):
+            info.channel.connect()
 
         all_channels = self.channels()
         if all_channels:
@@ -284,6 +506,10 @@ class TyphosAlarm(TyphosObject, PyDMDrawing, _KindLevel, _AlarmLevel):
                 'did not configure any channels! Check your kindLevel!'
             )
 
+        if not self._pending_discovery and self.signal_info:
+            # Catch up on any summary held off during discovery
+            self.update_current_alarm()
+
     def update_alarm_config(self):
         """
         Clean up the existing alarm config and create a new one.
@@ -293,19 +519,103 @@ class TyphosAlarm(TyphosObject, PyDMDrawing, _KindLevel, _AlarmLevel):
         """
         self.clear_all_alarm_configs()
         for dev in self.devices:
+            # Our settings changed, so walk the device again
+            clear_alarm_signal_cache(dev)
             self.setup_alarm_config(dev)
 
-    def update_connection(self, connected, addr):
-        """Slot that will be called when a PV connects or disconnects."""
-        self.signal_info[addr].connected = connected
+    def _create_signal_info(self, address, signal_name=''):
+        """
+        Create a SignalInfo along with the PyDMChannel that feeds it.
+
+        The channel reports directly to the SignalInfo's slots, which pass
+        any alarm transitions along to our alarm counts.
+        """
+        info = SignalInfo(
+            address=address,
+            channel=None,
+            signal_name=signal_name,
+            connected=False,
+            severity=AlarmLevel.INVALID,
+        )
+        info.alarm_callback = self._queue_alarm_change
+        info.channel = PyDMChannel(
+            address=address,
+            connection_slot=info.update_connection,
+            severity_slot=info.update_severity,
+        )
+        return info
+
+    def _add_signal_info(self, info):
+        """Start tracking a signal's alarm state in the summary."""
+        self.signal_info[info.address] = info
+        self._alarm_counts[info.alarm] += 1
+
+    def _device_uses(self, addr):
+        """Whether any of our devices includes ``addr`` in its summary."""
+        return any(
+            info.address == addr
+            for infos in self.device_info.values()
+            for info in infos
+        )
+
+    def _remove_signal_info(self, addr):
+        """Stop tracking a signal's alarm state in the summary."""
+        self._uncount_signal_info(self.signal_info.pop(addr))
+
+    def _uncount_signal_info(self, info):
+        """Detach a SignalInfo and take it back out of the alarm counts."""
+        info.alarm_callback = None
+        _, counted_alarm = self._pending_alarms.pop(
+            id(info), (info, info.alarm))
+        self._alarm_counts[counted_alarm] -= 1
+
+    def _queue_alarm_change(self, info, old_alarm):
+        """
+        Note that a signal has changed alarm level since it was last counted.
+
+        Only the level the signal is counted at is remembered, so a burst of
+        updates to one PV collapses into a single change of the alarm counts
+        when the summary is next evaluated.
+        """
+        if info.alarm == old_alarm:
+            # e.g. a severity update while disconnected
+            return
+        self._pending_alarms.setdefault(id(info), (info, old_alarm))
         self.update_current_alarm()
 
+    def _apply_pending_alarms(self):
+        """Fold the queued alarm level changes into the alarm counts."""
+        for info, counted_alarm in self._pending_alarms.values():
+            self._alarm_counts[counted_alarm] -= 1
+            self._alarm_counts[info.alarm] += 1
+        self._pending_alarms.clear()
+
+    def update_connection(self, connected, addr):
+        """Update the connection state of the PV at ``addr``."""
+        self.signal_info[addr].update_connection(connected)
+
     def update_severity(self, severity, addr):
-        """Slot that will be called when a PV's alarm severity changes."""
-        self.signal_info[addr].severity = severity
-        self.update_current_alarm()
+        """Update the alarm severity of the PV at ``addr``."""
+        self.signal_info[addr].update_severity(severity)
 
     def update_current_alarm(self):
+        """
+        Schedule a check of the current worst available alarm state.
+
+        Updates that arrive in quick succession are coalesced so that the
+        summary is evaluated, and "alarm_changed" emitted, at most once per
+        ``alarm_update_interval_ms``.
+        """
+        try:
+            # Don't restart a pending timer, or a steady stream of updates
+            # could hold off the summary indefinitely.
+            if not self._alarm_update_timer.isActive():
+                self._alarm_update_timer.start()
+        except RuntimeError:
+            # Widget was destroyed and not properly cleaned up
+            logger.debug('Dangling reference to alarm widget!')
+
+    def _update_current_alarm(self):
         """
         Check what the current worst available alarm state is.
 
@@ -313,10 +623,18 @@ class TyphosAlarm(TyphosObject, PyDMDrawing, _KindLevel, _AlarmLevel):
         emit the "alarm_changed" signal. This signal is configured at
         init to change the color of this widget.
         """
+        self._apply_pending_alarms()
+        if self._pending_discovery:
+            # Wait until every device has its channels in place
+            return
         if not self.signal_info:
             new_alarm = AlarmLevel.INVALID
         else:
-            new_alarm = max(info.alarm for info in self.signal_info.values())
+            # The worst alarm is the highest level with any signals in it
+            new_alarm = next(
+                level for level in reversed(AlarmLevel)
+                if self._alarm_counts[level]
+            )
         if new_alarm != self.alarm_summary:
             try:
                 self.alarm_changed.emit(new_alarm)
@@ -325,9 +643,11 @@ class TyphosAlarm(TyphosObject, PyDMDrawing, _KindLevel, _AlarmLevel):
                 logger.debug('Dangling reference to alarm widget!')
                 return
             else:
+                all_channels = self.channels()
                 logger.debug(
                     f'Updated alarm from {self.alarm_summary} to {new_alarm} '
-                    f'on alarm widget with channel {self.channels()[0]}'
+                    f'on alarm widget with channel '
+                    f'{all_channels[0] if all_channels else None}'
                 )
         self.alarm_summary = new_alarm
 
@@ -335,7 +655,11 @@ class TyphosAlarm(TyphosObject, PyDMDrawing, _KindLevel, _AlarmLevel):
         """
         Change the alarm color to the shade defined by the current alarm level.
         """
-        self.setStyleSheet(indicator_stylesheet(self.__class__, alarm_level))
+        stylesheet = self._stylesheets[alarm_level]
+        # setStyleSheet re-polishes the widget even if nothing changed.
+        # Check the live stylesheet, as it may have been set elsewhere.
+        if stylesheet != self.styleSheet():
+            self.setStyleSheet(stylesheet)
 
     def eventFilter(self, obj, event):
         """
@@ -420,6 +744,23 @@ class TyphosAlarmPolygon(TyphosAlarm, PyDMDrawingPolygon):
     numberOfPoints = PyDMDrawingPolygon.numberOfPoints
 
 
+# Indicator brush colors for each alarm level
+_INDICATOR_RGBA = {
+    AlarmLevel.NO_ALARM: '(0,255,0,255)',
+    AlarmLevel.MINOR: '(255,255,0,255)',
+    AlarmLevel.MAJOR: '(255,0,0,255)',
+    AlarmLevel.INVALID: '(255,0,255,255)',
+    AlarmLevel.DISCONNECTED: '(255,255,255,255)',
+}
+
+_INDICATOR_STYLESHEET = (
+    '%s '
+    '{border: none; '
+    ' background: transparent;'
+    ' qproperty-brush: rgba%s;}'
+)
+
+
 def indicator_stylesheet(shape_cls, alarm):
     """
     Create the indicator stylesheet that will modify a PyDMDrawing's color.
@@ -437,22 +778,27 @@ def indicator_stylesheet(shape_cls, alarm):
     indicator_stylesheet : str
         The correctly colored stylesheet to apply to the widget.
     """
-    base = (
-        f'{shape_cls.__name__} '
-        '{border: none; '
-        ' background: transparent;'
-        ' qproperty-brush: rgba'
-    )
+    try:
+        rgba = _INDICATOR_RGBA[alarm]
+    except (KeyError, TypeError):
+        raise ValueError(f'Recieved invalid alarm level {alarm}') from None
+    return _INDICATOR_STYLESHEET % (shape_cls.__name__, rgba)
+
+
+@lru_cache(maxsize=None)
+def _indicator_stylesheets(shape_cls):
+    """
+    Create the indicator stylesheets for every alarm level of a widget class.
+
+    Parameters
+    ----------
+    shape_cls : type
+        The PyDMDrawing widget subclass.
 
-    if alarm == AlarmLevel.DISCONNECTED:
-        return base + '(255,255,255,255);}'
-    elif alarm == AlarmLevel.NO_ALARM:
-        return base + '(0,255,0,255);}'
-    elif alarm == AlarmLevel.MINOR:
-        return base + '(255,255,0,255);}'
-    elif alarm == AlarmLevel.MAJOR:
-        return base + '(255,0,0,255);}'
-    elif alarm == AlarmLevel.INVALID:
-        return base + '(255,0,255,255);}'
-    else:
-        raise ValueError(f'Recieved invalid alarm level {alarm}')
+    Returns
+    -------
+    stylesheets : tuple of str
+        The stylesheets from :func:`indicator_stylesheet`, indexed by
+        AlarmLevel.
+    """
+    return tuple(indicator_stylesheet(shape_cls, alarm) for alarm in AlarmLevel)
@@ -1,3 +1,4 @@
+import threading
 from uuid import uuid4
 
 import pytest
@@ -5,13 +6,17 @@ from happi.item import HappiItem
 from happi.loader import from_container
 from ophyd import Component as Cpt
 from ophyd import Device
+from ophyd.device import Kind
 from ophyd.utils.epics_pvs import AlarmSeverity
 
-from typhos.alarm import (AlarmLevel, TyphosAlarmCircle, TyphosAlarmEllipse,
-                          TyphosAlarmPolygon, TyphosAlarmRectangle,
-                          TyphosAlarmTriangle)
+from typhos.alarm import (AlarmLevel, KindLevel, TyphosAlarmCircle,
+                          TyphosAlarmEllipse, TyphosAlarmPolygon,
+                          TyphosAlarmRectangle, TyphosAlarmTriangle,
+                          clear_alarm_signal_cache, get_alarm_signals,
+                          indicator_stylesheet)
 from typhos.plugins.core import register_signal
 from typhos.plugins.happi import HappiClientState, register_client
+from typhos.utils import channel_from_signal
 
 from .conftest import RichSignal, show_widget
 
@@ -41,6 +46,15 @@ class SimpleDevice(Device):
     omit_sig = Cpt(RichSignal, kind='omitted')
 
 
+class NestedDevice(Device):
+    sub = Cpt(SimpleDevice)
+
+
+class BrokenDevice(SimpleDevice):
+    def walk_signals(self, *args, **kwargs):
+        raise RuntimeError('Cannot walk this device')
+
+
 @pytest.fixture(scope='function')
 def device():
     return SimpleDevice(name='simple_' + str(uuid4()))
@@ -162,3 +176,216 @@ def test_kinds_many_alarms_add_device(alarm_add_device, device, qtbot):
         device.hint_sig.update_metadata({'connected': False})
 
     assert alarm.alarm_summary == AlarmLevel.DISCONNECTED
+
+
+def test_alarm_counts_match_signal_info(alarm_add_device, device, qtbot):
+    alarm = alarm_add_device
+    with qtbot.wait_signal(alarm.alarm_changed, timeout=1000):
+        alarm.kindLevel = alarm.KindLevel.OMITTED
+    assert len(alarm.signal_info) == 4
+
+    device.norm_sig.update_metadata({'severity': AlarmSeverity.MINOR})
+    device.conf_sig.update_metadata({'severity': AlarmSeverity.MAJOR})
+    device.omit_sig.update_metadata({'connected': False})
+
+    def counts_match():
+        expected = [0] * len(AlarmLevel)
+        for info in alarm.signal_info.values():
+            expected[info.alarm] += 1
+        assert alarm._alarm_counts == expected
+
+    qtbot.waitUntil(counts_match, timeout=1000)
+    qtbot.waitUntil(
+        lambda: alarm.alarm_summary == AlarmLevel.DISCONNECTED,
+        timeout=1000,
+    )
+
+
+def test_alarm_updates_coalesced(alarm_add_device, device, qtbot):
+    alarm = alarm_add_device
+    emitted = []
+    alarm.alarm_changed.connect(emitted.append)
+
+    with qtbot.wait_signal(alarm.alarm_changed, timeout=1000):
+        device.hint_sig.update_metadata({'severity': AlarmSeverity.MINOR})
+        device.hint_sig.update_metadata({'severity': AlarmSeverity.MAJOR})
+        device.hint_sig.update_metadata({'severity': AlarmSeverity.INVALID})
+
+    assert emitted == [AlarmLevel.INVALID]
+
+
+@pytest.mark.parametrize(
+    "alarm_level,rgba",
+    [
+        (AlarmLevel.NO_ALARM, '(0,255,0,255)'),
+        (AlarmLevel.MINOR, '(255,255,0,255)'),
+        (AlarmLevel.MAJOR, '(255,0,0,255)'),
+        (AlarmLevel.INVALID, '(255,0,255,255)'),
+        (AlarmLevel.DISCONNECTED, '(255,255,255,255)'),
+    ]
+)
+def test_indicator_stylesheet(alarm_level, rgba):
+    stylesheet = indicator_stylesheet(TyphosAlarmCircle, alarm_level)
+    assert stylesheet.startswith('TyphosAlarmCircle {')
+    assert f'qproperty-brush: rgba{rgba};' in stylesheet
+
+
+@pytest.mark.parametrize("alarm_level", [-1, 5, None])
+def test_indicator_stylesheet_invalid(alarm_level):
+    with pytest.raises(ValueError):
+        indicator_stylesheet(TyphosAlarmCircle, alarm_level)
+
+
+def test_get_alarm_signals(device):
+    hinted = get_alarm_signals(device, KindLevel.HINTED)
+    assert hinted == [device.hint_sig]
+    assert get_alarm_signals(device, KindLevel.HINTED) == hinted
+    assert get_alarm_signals(device, KindLevel.NORMAL) == [
+        device.hint_sig, device.norm_sig
+    ]
+    assert get_alarm_signals(device, KindLevel.CONFIG) == [
+        device.hint_sig, device.norm_sig, device.conf_sig
+    ]
+    assert len(get_alarm_signals(device, KindLevel.OMITTED)) == 4
+
+
+def test_alarm_shared_signal(alarm, qtbot):
+    # The parent and its sub-device both include sub.hint_sig
+    outer = NestedDevice(name='nested_' + str(uuid4()))
+
+    with qtbot.wait_signal(alarm.alarm_changed, timeout=1000):
+        alarm.add_device(outer)
+        alarm.add_device(outer.sub)
+
+    qtbot.waitUntil(lambda: len(alarm.device_info) == 2, timeout=1000)
+    assert len(alarm.signal_info) == 1
+    assert len(alarm.channels()) == 1
+    assert alarm.alarm_summary == AlarmLevel.NO_ALARM
+
+    with qtbot.wait_signal(alarm.alarm_changed, timeout=1000):
+        outer.sub.hint_sig.update_metadata({'severity': AlarmSeverity.MAJOR})
+
+    assert alarm.alarm_summary == AlarmLevel.MAJOR
+    assert alarm._alarm_counts == [0, 0, 1, 0, 0]
+
+
+def test_alarm_sig_ch_swap(alarm, qtbot):
+    names = ['swap_sig_ch_' + str(uuid4()) for _ in range(2)]
+    for name in names:
+        register_signal(RichSignal(name=name))
+
+    with qtbot.wait_signal(alarm.alarm_changed, timeout=1000):
+        alarm.channel = 'sig://' + names[0]
+
+    alarm.channel = 'sig://' + names[1]
+    assert list(alarm.signal_info) == ['sig://' + names[1]]
+    qtbot.waitUntil(
+        lambda: alarm._alarm_counts == [1, 0, 0, 0, 0],
+        timeout=1000,
+    )
+
+
+def test_alarm_sig_ch_shared_with_device(alarm_add_device, device, qtbot):
+    alarm = alarm_add_device
+    addr = channel_from_signal(device.hint_sig)
+    info = alarm.signal_info[addr]
+
+    alarm.channel = addr
+    assert alarm.signal_info[addr] is info
+    assert len(alarm.channels()) == 1
+    assert alarm._alarm_counts == [1, 0, 0, 0, 0]
+
+    # Moving the channel elsewhere leaves the device's summary alone
+    name = 'shared_sig_ch_' + str(uuid4())
+    register_signal(RichSignal(name=name))
+    alarm.channel = 'sig://' + name
+    assert alarm.signal_info[addr] is info
+    with qtbot.wait_signal(alarm.alarm_changed, timeout=1000):
+        device.hint_sig.update_metadata({'severity': AlarmSeverity.MAJOR})
+    assert alarm.alarm_summary == AlarmLevel.MAJOR
+
+
+def test_alarm_reset_cancels_pending_update(alarm_add_device, device, qtbot):
+    alarm = alarm_add_device
+    emitted = []
+    alarm.alarm_changed.connect(emitted.append)
+
+    device.hint_sig.update_metadata({'severity': AlarmSeverity.MAJOR})
+    alarm.clear_all_alarm_configs()
+    qtbot.wait(3 * alarm.alarm_update_interval_ms)
+
+    assert not emitted
+    assert alarm.alarm_summary == AlarmLevel.DISCONNECTED
+
+
+def test_alarm_discovery_failure(alarm, device, qtbot):
+    broken = BrokenDevice(name='broken_' + str(uuid4()))
+    alarm.add_device(broken)
+
+    with qtbot.wait_signal(alarm.alarm_changed, timeout=1000):
+        alarm.add_device(device)
+    assert alarm.alarm_summary == AlarmLevel.NO_ALARM
+
+    with qtbot.wait_signal(alarm.alarm_changed, timeout=1000):
+        device.hint_sig.update_metadata({'severity': AlarmSeverity.MAJOR})
+    assert alarm.alarm_summary == AlarmLevel.MAJOR
+
+
+def test_get_alarm_signals_refresh(alarm_add_device, device, qtbot):
+    alarm = alarm_add_device
+    assert get_alarm_signals(device, KindLevel.HINTED) == [device.hint_sig]
+
+    device.norm_sig.kind = Kind.hinted
+    clear_alarm_signal_cache(device)
+    assert get_alarm_signals(device, KindLevel.HINTED) == [
+        device.hint_sig, device.norm_sig
+    ]
+
+    # Changing kindLevel walks the device again
+    device.norm_sig.kind = Kind.normal
+    alarm.kindLevel = alarm.KindLevel.NORMAL
+    with qtbot.wait_signal(alarm.alarm_changed, timeout=1000):
+        alarm.kindLevel = alarm.KindLevel.HINTED
+    assert list(alarm.signal_info) == [
+        channel_from_signal(device.hint_sig)
+    ]
+
+
+def test_get_alarm_signals_shared_walk(device):
+    release = threading.Event()
+    calls = []
+    walk_signals = device.walk_signals
+
+    def slow_walk_signals(*args, **kwargs):
+        calls.append(threading.current_thread())
+        release.wait(timeout=5)
+        return walk_signals(*args, **kwargs)
+
+    device.walk_signals = slow_walk_signals
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(
+                get_alarm_signals(device, KindLevel.HINTED)
+            )
+        )
+        for _ in range(3)
+    ]
+    for thread in threads:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join(timeout=5)
+
+    assert len(calls) == 1
+    assert results == [[device.hint_sig]] * 3
+
+
+def test_alarm_color_after_external_stylesheet(alarm):
+    expected = indicator_stylesheet(type(alarm), AlarmLevel.DISCONNECTED)
+    assert alarm.styleSheet() == expected
+
+    alarm.setStyleSheet('')
+    alarm.set_alarm_color(AlarmLevel.DISCONNECTED)
+    assert alarm.styleSheet() == expected
+
@@ -18,7 +18,7 @@ from ophyd.positioner import SoftPositioner
 from ophyd.sim import SynAxis
 from ophyd.utils.errors import LimitError, UnknownStatusFailure
 
-from typhos.alarm import KindLevel
+from typhos.alarm import AlarmLevel, KindLevel
 from typhos.positioner import TyphosPositionerWidget
 from typhos.status import TyphosStatusMessage, TyphosStatusResult
 from typhos.utils import SignalRO
@@ -231,6 +231,11 @@ def test_positioner_widget_alarm_text_changes(motor_widget, qtbot):
         update_alarm(level)
         alarm_texts.append(get_alarm_text())
 
+    # Alarm updates are coalesced, let the initial connection settle first
+    qtbot.waitUntil(
+        lambda: widget.ui.alarm_circle.alarm_summary == AlarmLevel.NO_ALARM,
+        timeout=1000,
+    )
     update_alarm(0, connected=False)
 
     for num in range(4):